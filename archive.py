@@ -9,11 +9,18 @@ import sys
 import argparse
 import json
 import sqlite3
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from itertools import islice
 
 from matrix_client.client import MatrixClient
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from pony.orm import *
 
@@ -30,7 +37,45 @@ if EXCLUDED_ROOM_IDS is None:
     EXCLUDED_ROOM_IDS = []
 else:
     EXCLUDED_ROOM_IDS = EXCLUDED_ROOM_IDS.split(',')
-MAX_FILESIZE = os.environ.get('MAX_FILESIZE', 1099511627776)  # 1 TB max filesize.
+# Walk back to the start of rooms without a sync cursor, instead of stopping at
+# archived events. Fills gaps in archives made by older versions.
+REWALK_HISTORY = bool(os.environ.get('REWALK_HISTORY'))
+MAX_FILESIZE = int(os.environ.get('MAX_FILESIZE', 1099511627776))  # 1 TB max filesize.
+COMMIT_INTERVAL = 10000  # Events per transaction when fetching a room's new events.
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MB
+SPOOL_MAX_SIZE = 8 << 20  # Downloads bigger than 8 MB are spooled to disk.
+DOWNLOAD_WORKERS = 32  # Concurrent file downloads and avatar lookups.
+
+# Shared HTTP session, so Matrix API calls and file downloads reuse pooled
+# keep-alive connections.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=16,
+                                      pool_maxsize=64,
+                                      max_retries=Retry(total=3,
+                                                        backoff_factor=0.5,
+                                                        status_forcelist=[500, 502, 503, 504])))
+download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+
+# Serialize to JSON text, using orjson when it's installed (it's several times faster).
+# Otherwise match its compact, unescaped output with the stdlib encoder.
+if orjson is not None:
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            # orjson rejects integers over 64 bits and lone surrogates, which
+            # the stdlib encoder handles (escaping the surrogates).
+            return json.dumps(obj)
+else:
+    def dumps(obj):
+        text = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        # Lone surrogates can't be stored as UTF-8 text, so those get escaped.
+        if not text.isascii():
+            try:
+                text.encode()
+            except UnicodeEncodeError:
+                return json.dumps(obj, separators=(",", ":"))
+        return text
 
 
 # ----------------------------------------------------------------------------
@@ -43,6 +88,8 @@ class Room(db.Entity):
     room_id = Required(str, unique=True)
     display_name = Required(str)
     topic = Optional(str, nullable=True)
+    sync_cursor = Optional(str, nullable=True) # Matrix token up to which events are archived.
+    backfill_cursor = Optional(str, nullable=True) # Matrix token an interrupted backward walk resumes from.
     members = Set('Member')
     events = Set('Event')
     retrieval_ts = Required(datetime, default=lambda: datetime.utcnow())
@@ -68,7 +115,6 @@ class Device(db.Entity):
 class Event(db.Entity):
     id = PrimaryKey(int, auto=True)
     room = Required(Room)
-    content = Required(Json)
     sender = Required(str)
     type = Required(str)
     event_id = Required(str, unique=True)
@@ -76,11 +122,12 @@ class Event(db.Entity):
     origin_server_ts = Required(datetime)
     raw_json = Required(Json)
     retrieval_ts = Required(datetime, default=lambda: datetime.utcnow())
+    composite_index(room, origin_server_ts) # Serves the "latest events in a room" query.
 
 class File(db.Entity):
     id = PrimaryKey(int, auto=True)
     filename = Required(str)
-    size = Required(int) # Size of file in bytes.
+    size = Required(int, size=64) # Size of file in bytes.
     mime_type = Optional(str, nullable=True)
     is_image = Required(bool, default=False) # Flag to make queries easier.
     is_cached = Required(bool, default=False) # Flag to make queries easier.
@@ -98,6 +145,70 @@ class File(db.Entity):
 # Default setting. Useful for testing.
 db_provider = os.environ.get('DB_PROVIDER', 'sqlite')
 
+# Raw SQL for the bulk insert fast paths, which go around the ORM.
+# Unquoted names match Pony's table/column names on both SQLite and Postgres.
+SQL_PARAM = "%s" if db_provider == "postgres" else "?"
+
+def insert_sql(table, columns):
+    return "INSERT INTO {}({}) VALUES ({})".format(table, ", ".join(columns), ", ".join([SQL_PARAM] * len(columns)))
+
+# `ON CONFLICT DO NOTHING` lets the UNIQUE indexes drop rows we already have.
+INSERT_EVENT_SQL = insert_sql("Event", ["room", "sender", "type", "event_id", "room_id", "origin_server_ts", "raw_json", "retrieval_ts"]) + " ON CONFLICT DO NOTHING"
+INSERT_MEMBER_SQL = insert_sql("Member", ["room", "display_name", "user_id", "room_id", "avatar_url", "retrieval_ts"])
+INSERT_DEVICE_SQL = insert_sql("Device", ["user_id", "device_id", "display_name", "last_seen_ts", "last_seen_ip", "retrieval_ts"])
+
+# Use a WAL journal and only fsync at checkpoints. This survives process
+# crashes (though not power loss), and makes each commit much cheaper.
+# Bigger pages, a bigger cache and mmap'd reads also cut down on syscalls
+# when scanning big archives.
+@db.on_connect(provider='sqlite')
+def sqlite_pragmas(db, connection):
+    cursor = connection.cursor()
+    # Only takes effect on a new, empty DB, so it must come before switching to WAL.
+    cursor.execute("PRAGMA page_size = 8192")
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.execute("PRAGMA journal_size_limit = 6144000")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.execute("PRAGMA cache_size = -131072")  # 128 MB page cache.
+    cursor.execute("PRAGMA mmap_size = 268435456")  # Read through a 256 MB memory map.
+
+# Bring tables from archives made by older versions up to date.
+@db_session(ddl=True)
+def upgrade_schema():
+    def columns(table):
+        cursor = db.execute("SELECT * FROM {} WHERE 1 = 0".format(table))
+        return [column[0].lower() for column in cursor.description]
+
+    # Events used to store `content` separately. Its data is a copy of
+    # `raw_json['content']`, and the column is NOT NULL.
+    if "content" in columns("Event"):
+        # Those versions also stored `raw_json` as a JSON string holding the
+        # event's JSON, so decode it in place before dropping the other copy.
+        print("Converting double-encoded 'raw_json' values in the Event table...")
+        if db_provider == "postgres":
+            db.execute("UPDATE Event SET raw_json = (raw_json #>> '{}')::jsonb "
+                       "WHERE jsonb_typeof(raw_json) = 'string'")
+        else:
+            db.execute("UPDATE Event SET raw_json = json_extract(raw_json, '$$') "
+                       "WHERE json_type(raw_json) = 'text'")
+        print("Dropping redundant 'content' column from the Event table...")
+        db.execute("ALTER TABLE Event DROP COLUMN content")
+    if "sync_cursor" not in columns("Room"):
+        print("Adding 'sync_cursor' column to the Room table...")
+        db.execute("ALTER TABLE Room ADD COLUMN sync_cursor TEXT")
+    if "backfill_cursor" not in columns("Room"):
+        print("Adding 'backfill_cursor' column to the Room table...")
+        db.execute("ALTER TABLE Room ADD COLUMN backfill_cursor TEXT")
+    # `File.size` used to be a 32-bit integer, which can't hold files of 2 GB
+    # or more. SQLite's INTEGER columns are already 64-bit.
+    if db_provider == "postgres":
+        cursor = db.execute("SELECT data_type FROM information_schema.columns "
+                            "WHERE table_name = 'file' AND column_name = 'size'")
+        if cursor.fetchone()[0] != "bigint":
+            print("Widening 'size' column in the File table...")
+            db.execute("ALTER TABLE File ALTER COLUMN size TYPE bigint")
+
 # Avoid running configuration stuff when generating Sphinx docs.
 # Cite: https://stackoverflow.com/a/45441490
 if 'sphinx' not in sys.modules:
@@ -113,25 +224,48 @@ if 'sphinx' not in sys.modules:
                 host=os.environ['DB_HOST'],
                 port=port,
                 database=os.environ['DB_NAME'])
-        db.generate_mapping(create_tables=True)
+        # Tables are checked against the models after any schema upgrades.
+        db.generate_mapping(create_tables=True, check_tables=False)
+        upgrade_schema()
+        db.check_tables()
         print("Connected to database: {}".format(os.environ['DB_NAME']))
     elif db_provider == "sqlite":
         # Connect to DB and auto-gen tables as needed.
+        # Pony already runs SQLite in autocommit mode and issues its own
+        # BEGIN/COMMIT; a bigger statement cache keeps our raw SQL prepared.
         db.bind(provider='sqlite',
                 filename='db.sqlite',
-                create_db=True)
-        db.generate_mapping(create_tables=True)
+                create_db=True,
+                cached_statements=1024)
+        # Tables are checked against the models after any schema upgrades.
+        db.generate_mapping(create_tables=True, check_tables=False)
+        upgrade_schema()
+        db.check_tables()
+        # SQLite can't hold a value over SQLITE_LIMIT_LENGTH bytes (1 GB by
+        # default), so don't download files it couldn't store.
+        with db_session:
+            connection = db.get_connection()
+            if hasattr(connection, "getlimit"):
+                max_length = connection.getlimit(sqlite3.SQLITE_LIMIT_LENGTH)
+            else:
+                max_length = 1000000000  # SQLite's default SQLITE_MAX_LENGTH.
+        MAX_FILESIZE = min(MAX_FILESIZE, max_length)
         print("Connected to database: {}".format('db.sqlite'))
 
 
 # Borrowed straight from osteele/matrix-archive.
-def get_room_events(client, room_id):
-    """Iterate room events, starting at the cursor."""
-    room = client.get_rooms()[room_id]
+def get_room_events(room, prev_batch=None):
+    """Iterate batches of room events, walking back from the `prev_batch` token.
+
+    Starts from the room's latest events if `prev_batch` is None.
+    Yields `(events, end)` pairs, where `end` is the token to resume from.
+    """
     print(f" |---- Reading events from room {room.display_name!r}…")
-    yield from room.events
+    if prev_batch is None:
+        prev_batch = room.prev_batch
+        if room.events:
+            yield list(room.events), prev_batch
     batch_size = 1000  # empirically, this is the largest honored value
-    prev_batch = room.prev_batch
     while True:
         res = room.client.api.get_room_messages(room.room_id, prev_batch, 'b',
                                                 limit=batch_size)
@@ -139,38 +273,247 @@ def get_room_events(client, room_id):
         if not events:
             break
         print(f" |---- Read {len(events)} events...")
-        yield from events
+        yield events, res['end']
         prev_batch = res['end']
 
 
+def get_room_events_since(room, since):
+    """Iterate batches of room events after the `since` token, oldest first.
+
+    Yields `(events, end)` pairs, where `end` is the token to resume from.
+    """
+    print(f" |---- Reading new events from room {room.display_name!r}…")
+    batch_size = 1000
+    from_token = since
+    while True:
+        res = room.client.api.get_room_messages(room.room_id, from_token, 'f',
+                                                limit=batch_size)
+        events = res['chunk']
+        if not events:
+            break
+        print(f" |---- Read {len(events)} events...")
+        yield events, res['end']
+        from_token = res['end']
+
+
+def prefetch(iterable):
+    """Iterate `iterable` on a background thread, one item ahead of the caller.
+
+    Lets the next batch of events download while the current one is archived.
+    """
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(next, iterator, None)
+        while True:
+            item = pending.result()
+            if item is None:
+                return
+            pending = executor.submit(next, iterator, None)
+            yield item
+
+
+# Fetch a file's contents, giving up on anything at or over MAX_FILESIZE.
+# Returns the contents spooled into a temporary file, rewound and ready to read.
+# This runs on the download pool's threads, so it must not touch the DB.
+def download_file(http_download_url, filename, file_size):
+    contents = None
+    received = 0
+    is_cached = False
+    last_fetch_status = "Fail"
+    try:
+        # The event says how big the file is, so oversized files need no request at all.
+        received = file_size
+        if received < MAX_FILESIZE:
+            with session.get(http_download_url, stream=True, timeout=30) as req:
+                # Check the headers before reading any of the body.
+                received = int(req.headers.get("content-length", 0))
+                if received < MAX_FILESIZE:
+                    # Stream the body in chunks, so big files never sit in memory whole.
+                    contents = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                    received = 0
+                    for chunk in req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        received += len(chunk)
+                        if received >= MAX_FILESIZE:
+                            break
+                        contents.write(chunk)
+        if received < MAX_FILESIZE:
+            contents.seek(0)
+            is_cached = True
+            last_fetch_status = "{} {}".format(req.status_code, req.reason)
+        else:
+            print(" |     File: '{}' of size {} bytes was not archived due to size in excess of limit ({} bytes).".format(filename, file_size, MAX_FILESIZE))
+    except Exception as e:
+        print("       Could not fetch file. Traceback:\n       {}".format(e))
+        is_cached = False
+    if not is_cached and contents is not None:
+        contents.close()
+        contents = None
+    return contents, received, is_cached, last_fetch_status
+
+
+# Copy downloaded contents into `file_entry.data`. On SQLite (Python 3.11+)
+# this goes a chunk at a time through the incremental BLOB API.
+def store_file_data(file_entry, contents, size):
+    connection = db.get_connection()
+    if not hasattr(connection, "blobopen"):
+        file_entry.data = contents.read()
+        file_entry.flush()
+        return
+    cursor = connection.cursor()
+    cursor.execute("UPDATE File SET data = zeroblob(?) WHERE id = ?", (size, file_entry.id))
+    with connection.blobopen("File", "data", file_entry.id) as blob:
+        for chunk in iter(lambda: contents.read(DOWNLOAD_CHUNK_SIZE), b""):
+            blob.write(chunk)
+
+
 # Convert matrix timestamps to ISO8601 timestamps at highest resolution.
 def convert_to_iso8601(ts):
     return datetime.utcfromtimestamp(ts/1000).isoformat(timespec='milliseconds')
 
 
+# Format datetimes the way Pony stores them, for rows inserted with raw SQL.
+def convert_to_db_timestamp(dt):
+    return dt.isoformat(' ', timespec='microseconds')
+
+
+# Record the result of a file download, creating its File row if needed.
+def save_file(result, content, http_download_url, matrix_download_url, file_entry):
+    contents, size, is_cached, last_fetch_status = result
+    if file_entry is None:
+        file_entry = File(filename=content["body"],
+                          size=content["info"]["size"],
+                          mime_type=content["info"].get("mimetype"),
+                          is_image=(content["msgtype"] == "m.image"),
+                          is_cached=is_cached,
+                          fetch_url_http=http_download_url,
+                          fetch_url_matrix=matrix_download_url,
+                          last_fetch_status=last_fetch_status)
+    else:
+        if contents is not None:
+            file_entry.is_cached = is_cached
+        file_entry.last_fetch_status = last_fetch_status
+        file_entry.last_fetch_ts = datetime.utcnow().isoformat()
+    file_entry.flush()
+    # Fill in the data field if we had a successful fetch.
+    if contents is not None:
+        with contents:
+            store_file_data(file_entry, contents, size)
+
+
+# Archive a batch of events for room `r`, along with any files they link.
+# Returns how many of the events were new.
+def archive_events(r, events, retrieval_ts):
+    # Write the whole batch in one round-trip, bypassing the ORM.
+    # `raw_json` holds the event itself as JSON. Older versions stored it as a
+    # JSON-encoded string; upgrade_schema() converts those rows at startup.
+    rows = [(r.id,
+             e["sender"],
+             e["type"],
+             e["event_id"],
+             r.room_id,
+             convert_to_db_timestamp(datetime.utcfromtimestamp(e["origin_server_ts"]/1000)),
+             dumps(e),
+             retrieval_ts) for e in events]
+    cursor = db.get_connection().cursor()
+    cursor.executemany(INSERT_EVENT_SQL, rows)
+
+    # Fetch this batch's files concurrently, recording each one as it finishes.
+    # At most DOWNLOAD_WORKERS downloads are pending at once, which bounds how
+    # many finished downloads can sit in memory waiting to be written.
+    seen_urls = set()
+    pending_files = {}
+    for event in events:
+        content = event["content"]
+        # Download files if message.content['msgtype'] == 'm.file'
+        if "msgtype" in content.keys() and content["msgtype"] in ["m.file", "m.image"]:
+            print(" |---- Attempting to archive file: '{}'".format(content["body"]))
+            matrix_download_url = content["url"]
+            if matrix_download_url in seen_urls:
+                continue
+            seen_urls.add(matrix_download_url)
+            file_entry = File.get(fetch_url_matrix=matrix_download_url)
+            # If not cached, or last fetch failed, try fetching the file.
+            if file_entry is None or file_entry.is_cached == False:
+                if len(pending_files) >= DOWNLOAD_WORKERS:
+                    done, _ = wait(pending_files, return_when=FIRST_COMPLETED)
+                    for download in done:
+                        save_file(download.result(), *pending_files.pop(download))
+                http_download_url = client.api.get_download_url(matrix_download_url)
+                download = download_pool.submit(download_file, http_download_url, content["body"], content["info"]["size"])
+                pending_files[download] = (content, http_download_url, matrix_download_url, file_entry)
+            else:
+                print(" |------ Skipping because file is already archived!")
+    for download in as_completed(pending_files):
+        save_file(download.result(), *pending_files[download])
+    return cursor.rowcount
+
+
+# Walk back through room `r`'s history from the `prev_batch` token (or from
+# its latest events), until we hit archived events or the start of the room.
+# Returns how many new events were saved.
+def archive_room_history(r, room, prev_batch, last_event_ids, retrieval_ts):
+    new_events_saved = 0
+    uncommitted_events = 0
+    # Events will be pulled down in batches.
+    # Note: Insertion order will be off globally, but correct within a batch.
+    #   Users will need to ORDER BY `origin_server_ts` to get a globally correct ordering.
+    for event_batch, end in prefetch(get_room_events(room, prev_batch)):
+        incoming_event_ids = set([e["event_id"] for e in event_batch])
+        # Set difference of incoming versus last 1k events in DB.
+        diff = incoming_event_ids.difference(last_event_ids)
+        new_events = [e for e in event_batch if e["event_id"] in diff]
+        saved = archive_events(r, new_events, retrieval_ts)
+        new_events_saved += saved
+        uncommitted_events += saved
+        # Keep the next batch's diff correct.
+        last_event_ids |= incoming_event_ids
+
+        # Terminate if we hit known event IDs in this batch, whether among the
+        # latest events or (on a resumed walk) anywhere in the DB.
+        if not REWALK_HISTORY and (len(new_events) < len(event_batch) or saved < len(new_events)):
+            # An older backup may have gaps behind the events we hit (see
+            # "Known issues" in the README), so only a walk that reaches the
+            # start of the room leaves the sync cursor set.
+            r.sync_cursor = None
+            break
+        # Commit periodically along with where to resume from, so a crash
+        # partway through keeps its progress, and the next run carries on
+        # from here instead of stopping at the events saved so far.
+        r.backfill_cursor = end
+        if uncommitted_events >= COMMIT_INTERVAL:
+            commit()
+            uncommitted_events = 0
+    r.backfill_cursor = None
+    return new_events_saved
+
+
 @db_session
 def add_devices(devices):
     print("Archiving Device list for user.")
+    # One retrieval timestamp for the whole device list.
+    retrieval_ts = datetime.utcnow()
+    # Look up what we already have in one query, then insert the rest in one go.
+    archived_device_ids = set(select(d.device_id for d in Device))
+    rows = []
     for d in devices["devices"]:
-        user_id = d["user_id"]
         device_id = d["device_id"]
         display_name = d["display_name"]
-        last_seen_ts = d["last_seen_ts"]
-        last_seen_ip = d["last_seen_ip"]
-        item = Device.get(user_id=d["user_id"], device_id=d["device_id"])
-        if item is None:
-            # Fix up timestamp if it is present.
-            if last_seen_ts is not None:
-                last_seen_ts = convert_to_iso8601(last_seen_ts)
-            item = Device(user_id=user_id,
-                          device_id=device_id,
-                          display_name=display_name,
-                          last_seen_ts=last_seen_ts,
-                          last_seen_ip=last_seen_ip)
-            item.flush()
-        else:
+        if device_id in archived_device_ids:
             # We've seen this device before.
             print(" |-- Skipping Device: '{}' (Device ID: '{}') because it has already been archived.".format(display_name, device_id))
+            continue
+        archived_device_ids.add(device_id)
+        # Fix up timestamp if it is present.
+        last_seen_ts = d["last_seen_ts"]
+        if last_seen_ts is not None:
+            last_seen_ts = convert_to_iso8601(last_seen_ts)
+        rows.append((d["user_id"],
+                     device_id,
+                     display_name,
+                     last_seen_ts,
+                     d["last_seen_ip"],
+                     convert_to_db_timestamp(retrieval_ts)))
+    db.get_connection().cursor().executemany(INSERT_DEVICE_SQL, rows)
     commit()
 
 
@@ -182,15 +525,17 @@ def add_rooms(rooms):
         room = rooms[room_id]
         display_name = room.display_name
         print("Archiving Room: '{}' (Room ID: '{}')".format(display_name, room_id))
+        # One retrieval timestamp for everything archived from this room.
+        retrieval_ts = datetime.utcnow()
         # Skip rooms the user specifically wants to exclude.
         if room_id in EXCLUDED_ROOM_IDS:
             print(" |-- Skipping Room: '{}' (Room ID: '{}') because it is on the EXCLUDED list.".format(room.display_name, room_id))
             continue
-        # Topic retrieval can fail with a 404 sometimes.
-        try:
-            topic = json.dumps(client.api.get_room_topic(room_id))
-        except Exception as e:
-            topic = None
+        # The topic is already known from the room state in the initial sync,
+        # so there's no need to ask the server for it again.
+        topic = None
+        if room.topic is not None:
+            topic = dumps({"topic": room.topic})
 
         # See if the room already exists in the DB.
         print(" | Backing up room metadata...")
@@ -199,7 +544,8 @@ def add_rooms(rooms):
             # Room hasn't been archived before.
             item = Room(room_id=room_id,
                         display_name=display_name,
-                        topic=topic)
+                        topic=topic,
+                        retrieval_ts=retrieval_ts)
             item.flush()
             r = item
         else:
@@ -209,127 +555,70 @@ def add_rooms(rooms):
         # --------------------------------------------
         # Back up room members.
         print(" | Backing up list of room members...")
+        # Look up who we already have in one query, then insert the rest in one go.
+        archived_user_ids = set(select(m.user_id for m in Member if m.room == r))
+        new_members = []
         for member in room.get_joined_members():
-            display_name = member.displayname
-            user_id = member.user_id
-            avatar_url = member.get_avatar_url()
-            # See if the member already exists in the DB.
-            item = Member.get(room=r, user_id=user_id)
-            if item is None:
-                # Member hasn't been archived before.
-                item = Member(room=r,
-                              user_id=user_id,
-                              room_id=r.room_id,
-                              display_name=display_name,
-                              avatar_url=avatar_url)
-                item.flush()
-            else:
-                # We've seen this room before.
-                print(" |-- Skipping Member: '{}' (User ID: '{}') because it has already been archived.".format(display_name, user_id))
+            if member.user_id in archived_user_ids:
+                # We've seen this member before.
+                print(" |-- Skipping Member: '{}' (User ID: '{}') because it has already been archived.".format(member.displayname, member.user_id))
+                continue
+            archived_user_ids.add(member.user_id)
+            new_members.append(member)
+        # Each avatar URL is its own API request, so look them up concurrently.
+        avatar_urls = download_pool.map(lambda member: member.get_avatar_url(), new_members)
+        rows = [(r.id,
+                 member.displayname,
+                 member.user_id,
+                 r.room_id,
+                 avatar_url,
+                 convert_to_db_timestamp(retrieval_ts)) for member, avatar_url in zip(new_members, avatar_urls)]
+        db.get_connection().cursor().executemany(INSERT_MEMBER_SQL, rows)
 
         # --------------------------------------------
         # Back up room events.
         print(" | Backing up list of room events...")
-        events = get_room_events(client, room_id)
-        last_events = select(e for e in Event
-                             if e.room == r).order_by(desc(Event.origin_server_ts))[:1000]
-        last_event_ids = set()
-        if last_events is None or last_events == []:
-            # No existing backup. Let's make a new one.
-            print(" |-- No existing events backup for this room. Creating a new one...")
-        else:
-            # We've got an existing backup, let's add to it.
-            print(" |-- Checking to see if new events have occurred since the last backup...")
-            last_event_ids = set([e.event_id for e in last_events])
-            #print("Last event ID: {} timestamp: {}".format(last_event_id, last_event.origin_server_ts))
         new_events_saved = 0
-        # Events will be pulled down in batches.
-        # Note: Insertion order will be off globally, but correct within a batch.
-        #   Users will need to ORDER BY `origin_server_ts` to get a globally correct ordering.
-        stop_on_this_batch = False
-        event_batch = list(islice(events, 0, 1000))
-        while len(event_batch) > 0:
-            incoming_event_ids = set([e["event_id"] for e in event_batch])
-            # Set difference of incoming versus last 1k events in DB.
-            diff = incoming_event_ids.difference(last_event_ids)
-            for event in event_batch:
-                event_id = event["event_id"]
-                origin_server_ts = datetime.utcfromtimestamp(event["origin_server_ts"]/1000).isoformat(timespec='milliseconds')
-                #print("Current event ID: {} timestamp: {}".format(event_id, origin_server_ts))
-                # If we run into something we've already archived we'll be done after this batch.
-                if event_id not in diff:
-                    stop_on_this_batch = True
-                    continue
-                # Otherwise, archive this event.
-                new_events_saved += 1
-                content = event["content"]
-                sender = event["sender"]
-                type = event["type"]
-                origin_server_ts = datetime.utcfromtimestamp(event["origin_server_ts"]/1000).isoformat(timespec='milliseconds')
-                raw_json = json.dumps(event)
-
-                item = Event(room=r,
-                             event_id=event_id,
-                             room_id=r.room_id,
-                             content=content,
-                             sender=sender,
-                             type=type,
-                             origin_server_ts=origin_server_ts,
-                             raw_json=raw_json)
-                item.flush()
-
-                # Download files if message.content['msgtype'] == 'm.file'
-                if "msgtype" in item.content.keys() and item.content["msgtype"] in ["m.file", "m.image"]:
-                    print(" |---- Attempting to archive file: '{}'".format(item.content["body"]))
-                    filename = item.content["body"]
-                    file_size = item.content["info"]["size"]
-                    is_image = (item.content["msgtype"] == "m.image")
-                    matrix_download_url = item.content["url"]
-                    http_download_url = client.api.get_download_url(matrix_download_url)
-                    data = None
-                    is_cached = False
-                    last_fetch_status = "Fail"
-
-                    file_entry = File.get(fetch_url_matrix=matrix_download_url)
-                    # If not cached, or last fetch failed, try fetching the file.
-                    if file_entry is None or file_entry.is_cached == False:
-                        try:
-                            req = requests.get(http_download_url, stream=True)
-                            if int(req.headers["content-length"]) < MAX_FILESIZE:
-                                data = req.content
-                                is_cached = True
-                                last_fetch_status = "{} {}".format(req.status_code, req.reason)
-                            else:
-                                print(" |     File: '{}' of size {} bytes was not archived due to size in excess of limit ({} bytes).".format(filename, file_size, MAX_FILESIZE))
-                        except Exception as e:
-                            print("       Could not fetch file. Traceback:\n       {}".format(e))
-                            is_cached = False
-                    else:
-                        print(" |------ Skipping because file is already archived!")
-
-                    if file_entry is None:
-                        file_entry = File(filename=filename,
-                                          size=file_size,
-                                          mime_type=item.content["info"].get("mimetype"),
-                                          is_image=is_image,
-                                          is_cached=is_cached,
-                                          data=data,
-                                          fetch_url_http=http_download_url,
-                                          fetch_url_matrix=matrix_download_url,
-                                          last_fetch_status=last_fetch_status)
-                    else:
-                        # Update data field if we had a successful fetch.
-                        if data is not None:
-                            file_entry.data = data
-                        file_entry.last_fetch_status = last_fetch_status
-                        file_entry.last_fetch_ts = datetime.utcnow().isoformat()
-                    file_entry.flush()
-
-            # Terminate if we hit known event IDs in this batch.
-            if stop_on_this_batch:
-                break
-            # Fetch next batch.
-            event_batch = list(islice(events, 0, 1000))
+        uncommitted_events = 0
+        event_retrieval_ts = convert_to_db_timestamp(retrieval_ts)
+        if r.backfill_cursor is not None:
+            # An earlier run was interrupted partway through walking back
+            # through history, so carry on from where it left off.
+            print(" |-- Resuming the backup of older events from the last run...")
+            new_events_saved += archive_room_history(r, room, r.backfill_cursor, set(), event_retrieval_ts)
+        if r.sync_cursor is not None:
+            # We've got an existing backup, so only ask the server for what's newer.
+            print(" |-- Fetching events that have occurred since the last backup...")
+            for event_batch, end in prefetch(get_room_events_since(room, r.sync_cursor)):
+                saved = archive_events(r, event_batch, event_retrieval_ts)
+                new_events_saved += saved
+                uncommitted_events += saved
+                r.sync_cursor = end
+                # Commit periodically, so a crash partway through a big room keeps most of its progress.
+                if uncommitted_events >= COMMIT_INTERVAL:
+                    commit()
+                    uncommitted_events = 0
+        else:
+            # First backup of this room (or one made before rooms had a sync
+            # cursor), so walk back through history until we hit archived events
+            # or the start of the room.
+            last_events = select(e for e in Event
+                                 if e.room == r).order_by(desc(Event.origin_server_ts))[:1000]
+            last_event_ids = set()
+            if last_events is None or last_events == []:
+                # No existing backup. Let's make a new one.
+                print(" |-- No existing events backup for this room. Creating a new one...")
+            elif REWALK_HISTORY:
+                # Fetch the whole room again; archived events are skipped on insert.
+                print(" |-- Walking back through the whole room to fill in any missing events...")
+            else:
+                # We've got an existing backup, let's add to it.
+                print(" |-- Checking to see if new events have occurred since the last backup...")
+                last_event_ids = set([e.event_id for e in last_events])
+            # Everything up to the sync we start from will be archived once
+            # the walk reaches the start of the room.
+            r.sync_cursor = client.sync_token
+            new_events_saved += archive_room_history(r, room, None, last_event_ids, event_retrieval_ts)
         commit()
         print(" | Archived {} new events for room '{}'".format(new_events_saved, room.display_name))
 
@@ -362,6 +651,8 @@ if __name__ == '__main__':
 
     print("Signing into {}...".format(MATRIX_HOST))
     client = MatrixClient(MATRIX_HOST)
+    # Share our pooled session, so API calls and file downloads reuse connections.
+    client.api.session = session
     token = client.login(username=MATRIX_USER, password=MATRIX_PASSWORD, device_id="Matrix Archiver")
     #print("Token: {}".format(token))
 